@@ -9,48 +9,56 @@ to create training and validation `feed_dict` suppliers).
 from collections import OrderedDict
 
 import numpy as np
-from functools import reduce
+from functools import lru_cache, wraps
+import importlib
 import tensorflow as tf
-from tensorflow.examples.tutorials.mnist.input_data import read_data_sets
 import os
 from rfho.utils import as_list, np_normalize_data, merge_dicts
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pickle
+import copy
+
+# heavy optional dependencies are imported only by the functions that need them
+_MISSING_DEPENDENCY_WARNINGS = {
+    'pandas': 'pandas not found. Some load function might not work',
+    'scipy': 'scipy not found. Some load function might not work',
+    'sklearn': 'sklearn not found. Some load function might not work',
+    'intervaltree': 'intervaltree not found. WindowedData.tree will not work. (You can get intervaltree with pip!)',
+}
+
+
+@lru_cache(maxsize=None)
+def _optional_import(module_name):
+    """
+    Imports (once) an optional dependency of this module.
+
+    :param module_name: full name of the module, e.g. `scipy.sparse`
+    :return: the module, or None if it is not installed
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        print(sys.exc_info())
+        print(_MISSING_DEPENDENCY_WARNINGS.get(module_name.split('.')[0], '%s not found' % module_name))
+        return None
+
+
+def _sparse_scipy_matrices():
+    """
+    Scipy sparse matrix types supported by `Dataset`. Scipy is not imported here: if nobody imported
+    `scipy.sparse` yet, no sparse matrix can be around.
+    """
+    sc_sp = sys.modules.get('scipy.sparse')
+    return (sc_sp.csr_matrix, sc_sp.coo_matrix) if sc_sp else ()
+
+
+def _is_csr(what):
+    sc_sp = sys.modules.get('scipy.sparse')
+    return sc_sp is not None and isinstance(what, sc_sp.csr_matrix)
 
-try:
-    import pandas as pd
-except ImportError:
-    pd = None
-    print(sys.exc_info())
-    print('pandas not found. Some load function might not work')
-try:
-    import scipy.io as scio
-    from scipy import linalg
-    import scipy.sparse as sc_sp
-    import scipy as sp
-
-    SPARSE_SCIPY_MATRICES = (sc_sp.csr.csr_matrix, sc_sp.coo.coo_matrix)
-except ImportError:
-    scio, linalg, sp, sc_sp = None, None, None, None
-    SPARSE_SCIPY_MATRICES = ()
-    print(sys.exc_info())
-    print('scipy not found. Some load function might not work')
-
-try:
-    import sklearn.datasets as sk_dt
-    from sklearn.utils import shuffle as sk_shuffle
-except ImportError:
-    sk_dt, sk_shuffle = None, None
-    print('sklearn not found. Some load function might not work')
-
-try:
-    import intervaltree as it
-except ImportError:
-    it = None
-    print(sys.exc_info())
-    print('intervaltree not found. WindowedData will not work. (You can get intervaltree with pip!)')
-
-import _pickle as cpickle
 
 from_env = os.getenv('RFHO_DATA_FOLDER')
 if from_env:
@@ -146,22 +154,131 @@ class Datasets:
         :param datasets_s: 
         :return: a new dataset
         """
+        if len(datasets_s) == 1:  # no copies, but new Dataset objects with the same (stacked) info layout
+            d = datasets_s[0]
+            return Datasets(*[Dataset.stack(d[k]) if d[k] is not None else None for k in range(3)])
         return Datasets.from_list([Dataset.stack(*[d[k] for d in datasets_s if d[k] is not None])
                                    for k in range(3)])
 
 
+_BUFFER_POOL = {}  # (shape, dtype) -> list of free numpy arrays
+
+
+def borrow_buffer(shape, dtype):
+    """
+    Gets an array of the given shape and dtype from the buffer pool, allocating a new one only if no free
+    array is available. The content of the array is undefined.
+
+    :param shape: shape of the array
+    :param dtype: numpy type of the array
+    :return: a numpy array
+    """
+    free = _BUFFER_POOL.get((tuple(shape), np.dtype(dtype)))
+    return free.pop() if free else np.empty(shape, dtype=dtype)
+
+
+def return_buffer(array):
+    """
+    Gives back to the buffer pool an array obtained with `borrow_buffer`, so that it can be reused.
+
+    :param array: the array to recycle; it must not be used by the caller anymore
+    """
+    _BUFFER_POOL.setdefault((array.shape, array.dtype), []).append(array)
+
+
 def _maybe_cast_to_scalar(what):
     return what[0] if len(what) == 1 else what
 
 
 def convert_sparse_matrix_to_sparse_tensor(X):
-    if isinstance(X, sc_sp.csr.csr_matrix):
-        coo = X.tocoo()
-        indices = np.mat([coo.row, coo.col]).transpose()
-    else:
-        coo, indices = X, [X.row, X.col]
-    # data = np.array(coo.data, dtype=)
-    return tf.SparseTensor(indices, tf.constant(coo.data, dtype=tf.float32), coo.shape)
+    coo = X.tocoo() if _is_csr(X) else X
+    indices = np.stack((coo.row.astype(np.int64, copy=False), coo.col.astype(np.int64, copy=False)), axis=1)
+    return tf.SparseTensor(indices, coo.data.astype(np.float32, copy=False), coo.shape)
+
+
+class _SampleInfoSoA:
+    """
+    Per-example information stored as a dictionary of columns (key -> array with one entry per example)
+    instead of an array of dicts. Behaves like a sequence of dicts: integer indexing builds the dict of the example,
+    while slicing and fancy indexing return a new `_SampleInfoSoA` that indexes every column.
+    """
+
+    def __init__(self, columns, length):
+        self._cols = columns
+        self._n = length
+
+    @staticmethod
+    def from_dict(sample_info, length):
+        """
+        Builds the columns repeating the values of `sample_info` for `length` examples. Non-scalar values are
+        (shallow) copied for each example, so that changing the value of an example does not affect the others.
+
+        :param sample_info: a dict with the information shared by all the examples
+        :param length: number of examples
+        :return: a `_SampleInfoSoA`
+        """
+        columns = {}
+        for k, v in sample_info.items():
+            if np.isscalar(v):
+                columns[k] = np.full(length, v)
+            else:
+                columns[k] = np.empty(length, dtype=object)
+                columns[k][:] = [copy.copy(v) for _ in range(length)]
+        return _SampleInfoSoA(columns, length)
+
+    @property
+    def column_names(self):
+        return set(self._cols)
+
+    def column(self, key):
+        return self._cols[key]
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return (self[i] for i in range(self._n))
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):  # python scalars, as in the original dicts
+            return {k: v[item].item() if v.ndim == 1 and v.dtype != object else v[item]
+                    for k, v in self._cols.items()}
+        if isinstance(item, slice):
+            length = len(range(*item.indices(self._n)))
+        else:
+            item = np.asarray(item)
+            length = int(np.count_nonzero(item)) if item.dtype == bool else len(item)
+        return _SampleInfoSoA({k: v[item] for k, v in self._cols.items()}, length)
+
+    def to_array(self):
+        """
+        :return: an object array of dicts (the old representation)
+        """
+        res = np.empty(self._n, dtype=object)
+        res[:] = list(self)
+        return res
+
+
+def concatenate_sample_infos(sample_infos):
+    """
+    Concatenates the per-example information of several datasets. Column-wise representations with the same
+    keys are concatenated column by column; otherwise the result is an array of dicts.
+
+    :param sample_infos: list of `_SampleInfoSoA`, arrays or lists of dicts
+    :return: the concatenated sample information
+    """
+    if all(isinstance(si, _SampleInfoSoA) for si in sample_infos) and \
+            all(si.column_names == sample_infos[0].column_names for si in sample_infos):
+        return _SampleInfoSoA({k: np.concatenate([si.column(k) for si in sample_infos])
+                               for k in sample_infos[0].column_names},
+                              sum(len(si) for si in sample_infos))
+    # array of dicts: fill a single preallocated object array, skipping the temporaries of np.concatenate
+    res = np.empty(sum(len(si) for si in sample_infos), dtype=object)
+    offset = 0
+    for si in sample_infos:
+        res[offset:offset + len(si)] = list(si) if isinstance(si, _SampleInfoSoA) else si
+        offset += len(si)
+    return res
 
 
 class Dataset:
@@ -171,22 +288,31 @@ class Dataset:
      per-example basis and general infos.
     """
 
-    def __init__(self, data, target, sample_info=None, info=None):
+    def __init__(self, data, target, sample_info=None, info=None, mmap_path=None):
         """
 
         :param data: Numpy array containing data
         :param target: Numpy array containing targets
-        :param sample_info: either an array of dicts or a single dict, in which case it is cast to array of
-                                  dicts.
+        :param sample_info: either an array of dicts or a single dict, in which case it is stored column-wise
+                                  and behaves as an array of dicts.
         :param info: (optional) dictionary with further info about the dataset
+        :param mmap_path: (optional) if given, the (dense) data is written as float32 to this file and
+                            read back as a read-only `np.memmap`, so that it lives in the OS page cache rather
+                            than in the process memory.
         """
         self._tensor_mode = False
 
+        if mmap_path:
+            mm = np.memmap(mmap_path, dtype=np.float32, mode='w+', shape=data.shape)
+            mm[:] = data
+            mm.flush()
+            del mm
+            data = np.memmap(mmap_path, dtype=np.float32, mode='r', shape=data.shape)
         self._data = data
         self._target = target
         if sample_info is None:
             sample_info = {}
-        self.sample_info = np.array([sample_info] * self.num_examples) \
+        self.sample_info = _SampleInfoSoA.from_dict(sample_info, self.num_examples) \
             if isinstance(sample_info, dict) else sample_info
 
         assert self.num_examples == len(self.sample_info)
@@ -246,10 +372,14 @@ class Dataset:
     def convert_to_tensor(self, keep_sparse=True):
         matrices = ['_data', '_target']
         for att in matrices:
-            if keep_sparse and isinstance(self.__getattribute__(att), SPARSE_SCIPY_MATRICES):
+            if keep_sparse and isinstance(self.__getattribute__(att), _sparse_scipy_matrices()):
                 self.__setattr__(att, convert_sparse_matrix_to_sparse_tensor(self.__getattribute__(att)))
             else:
-                self.__setattr__(att, tf.convert_to_tensor(self.__getattribute__(att), dtype=tf.float32))
+                arr = self.__getattribute__(att)
+                if isinstance(arr, np.ndarray) and arr.dtype != np.float32:
+                    arr = arr.astype(np.float32)  # cast once here and drop the float64 array before TF copies it
+                    self.__setattr__(att, arr)
+                self.__setattr__(att, tf.convert_to_tensor(arr, dtype=tf.float32))
         self._tensor_mode = True
 
     def create_supplier(self, x, y, other_feeds=None):
@@ -262,6 +392,7 @@ class Dataset:
         :return: a callable.
         """
         if not other_feeds: other_feeds = {}
+        buffer, buffer_version = None, None
 
         # noinspection PyUnusedLocal
         def _supplier(step=None):
@@ -270,10 +401,20 @@ class Dataset:
             :param step: unused, just for making it compatible with `HG` and `Saver`
             :return: the feed dictionary
             """
+            nonlocal buffer, buffer_version
+            data = self.data
             if isinstance(self.data, WindowedData):
-                data = self.data.generate_all()
-
-            return {**{x: self.data, y: self.target}, **other_feeds}
+                if self.data.process_all:
+                    data = self.data.generate_all()
+                else:  # windows are generated once and regenerated only if the windowed data changes
+                    if buffer_version != self.data.version:
+                        if buffer is not None: return_buffer(buffer)
+                        buffer = borrow_buffer(self.data.shape, self.data.data.dtype)
+                        self.data.generate_all(out=buffer)
+                        buffer_version = self.data.version
+                    data = buffer
+
+            return {**{x: data, y: self.target}, **other_feeds}
 
         return _supplier
 
@@ -285,22 +426,48 @@ class Dataset:
         :param datasets: 
         :return: stacked dataset
         """
+        if len(datasets) == 1:  # nothing to stack: share the arrays instead of copying them
+            d = datasets[0]
+            return Dataset(data=d.data, target=d.target, sample_info=d.sample_info,
+                           info={k: [v] for k, v in d.info.items()})
         return Dataset(data=vstack([d.data for d in datasets]),
                        target=stack_or_concat([d.target for d in datasets]),
-                       sample_info=stack_or_concat([d.sample_info for d in datasets]),
+                       sample_info=concatenate_sample_infos([d.sample_info for d in datasets]),
                        info={k: [d.info.get(k, None) for d in datasets]
                              for k in merge_dicts(*[d.info for d in datasets])})
 
 
+def _one_hot(y, n=None, dtype=np.float32):
+    """
+    One hot encoding of integer labels, scattering the ones into a zero matrix.
+
+    :param y: integer labels (column vectors, e.g. from .mat files, are flattened)
+    :param n: (optional) number of classes, by default max(y) + 1
+    :param dtype: (default `np.float32`) type of the encoding
+    :return: array of shape (len(y), n)
+    """
+    y = np.asarray(y).ravel().astype(np.intp, copy=False)
+    n = n or int(y.max()) + 1
+    out = np.zeros((y.shape[0], n), dtype=dtype)
+    out[np.arange(y.shape[0]), y] = 1
+    return out
+
+
 def to_one_hot_enc(seq, dimension=None):
-    da_max = dimension or np.max(seq) + 1
+    return _one_hot(seq, dimension)
 
-    def create_and_set(_p):
-        _tmp = np.zeros(da_max)
-        _tmp[_p] = 1
-        return _tmp
 
-    return np.array([create_and_set(_v) for _v in seq])
+def read_csv_values(path, dtype=np.float32):
+    """
+    Reads a numeric csv file without header directly into a numpy array, avoiding the intermediate object-dtype
+    columns that pandas would otherwise build.
+
+    :param path: path of the csv file
+    :param dtype: (default `np.float32`) type of the resulting array
+    :return: a numpy array
+    """
+    pd = _optional_import('pandas')
+    return pd.read_csv(path, header=None, dtype=dtype, engine='c', memory_map=True).values
 
 
 def load_census():
@@ -308,6 +475,7 @@ def load_census():
                "marital_status", "occupation", "relationship", "race", "gender",
                "capital_gain", "capital_loss", "hours_per_week", "native_country",
                "income_bracket"]
+    pd = _optional_import('pandas')
     df_train = pd.read_csv(CENSUS_TRAIN, names=COLUMNS, skipinitialspace=True)
     df_test = pd.read_csv(CENSUS_TEST, names=COLUMNS, skipinitialspace=True, skiprows=1)
 
@@ -328,12 +496,12 @@ def load_iris(partitions_proportions=None, classes=3):
         features_dtype=np.float32)
 
     tr_set = training_set.data
-    tr_targets = to_one_hot_enc(training_set.target)
+    tr_targets = _one_hot(training_set.target)
 
     tr_dst = Dataset(data=tr_set, target=tr_targets)
 
     tst_set = test_set.data
-    tst_targets = to_one_hot_enc(test_set.target)
+    tst_targets = _one_hot(test_set.target)
     tst_dst = Dataset(data=tst_set, target=tst_targets)
 
     if partitions_proportions:
@@ -359,21 +527,50 @@ def load_iris(partitions_proportions=None, classes=3):
 
 
 def stack_or_concat(list_of_arays):
+    if len(list_of_arays) == 1:
+        return list_of_arays[0]
     func = np.concatenate if list_of_arays[0].ndim == 1 else np.vstack
     return func(list_of_arays)
 
 
 def vstack(lst):
     """
-    Vstack that considers sparse matrices
+    Vstack that considers sparse matrices: if any of the matrices is sparse the result is a CSR matrix
+    (dense blocks are never densified further). A single dense block is returned as it is, without copying it
     
     :param lst: 
     :return: 
     """
-    return sp.vstack(lst) if sp and isinstance(lst[0], sp.sparse.csr.csr_matrix) else np.vstack(lst)
+    sparse_types = _sparse_scipy_matrices()
+    if sparse_types and any(isinstance(m, sparse_types) for m in lst):
+        return _optional_import('scipy.sparse').vstack(lst, format='csr')
+    if len(lst) == 1:  # e.g. keeps memory maps as such
+        return lst[0]
+    return np.vstack(lst)
+
+
+def batched(func):
+    """
+    Decorator that marks a filter or a map for `redivide_data` as batched: it is called once with the whole
+    data, target and sample info arrays (plus the array of indices) instead of once per example.
+
+    :param func: the filter or map (left unchanged: it can still be used per example)
+    :return: a new function, wrapping `func`, marked as batched
+    """
+    @wraps(func)
+    def _batched(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    _batched.batched = True
+    return _batched
 
 
-def redivide_data(datasets, partition_proportions=None, shuffle=False, filters=None, maps=None, balance_classes=False):
+def _is_batched(func):
+    return getattr(func, 'batched', False)
+
+
+def redivide_data(datasets, partition_proportions=None, shuffle=False, filters=None, maps=None, balance_classes=False,
+                  class_indices=None):
     """
     Function that redivides datasets. Can be use also to shuffle or filter or map examples.
 
@@ -384,17 +581,24 @@ def redivide_data(datasets, partition_proportions=None, shuffle=False, filters=N
     If None it will retain the same proportion of samples found in datasets
     :param shuffle: (optional, default False) if True shuffles the examples
     :param filters: (optional, default None) filter or list of filters: functions with signature
-    (data, target, index) -> boolean (accept or reject the sample)
+    (data, target, sample_info, index) -> boolean (accept or reject the sample). Filters decorated with `batched`
+    receive instead all the examples at once (arrays, with an array of indices) and return a boolean mask.
     :param maps: (optional, default None) map or list of maps: functions with signature
-    (data, target, index) ->  (new_data, new_target) (maps the old sample to a new one, possibly also to more
-    than one sample, for data augmentation)
-    :return: a list of datasets of length equal to the (possibly augmented) partition_proportion
+    (data, target, sample_info, index) ->  (new_data, new_target, new_sample_info) (maps the old sample to a new
+    one, possibly also to more than one sample, for data augmentation). Maps decorated with `batched` receive
+    all the examples at once and return the three new arrays.
+    :param balance_classes: (optional, default False) if True all the partitions but the last one are balanced
+    :param class_indices: (optional, default None) dictionary class -> array of the indices (in the stacked
+    datasets) of the examples of that class, used when `balance_classes` is True to avoid scanning the labels
+    again. Ignored if there are filters or maps.
+    :return: a list of datasets of length equal to the (possibly augmented) partition_proportion. Without
+    shuffling, filters and maps the data of a single input dataset is sliced, not copied
     """
 
     all_data = vstack([get_data(d) for d in datasets])
     all_labels = stack_or_concat([get_targets(d) for d in datasets])
 
-    all_infos = np.concatenate([d.sample_info for d in datasets])
+    all_infos = concatenate_sample_infos([d.sample_info for d in datasets])
 
     N = all_data.shape[0]
 
@@ -407,47 +611,58 @@ def redivide_data(datasets, partition_proportions=None, shuffle=False, filters=N
     else:
         partition_proportions = [1. * get_data(d).shape[0] / N for d in datasets]
 
-    if shuffle:
-        if sp and isinstance(all_data, sp.sparse.csr.csr_matrix): raise NotImplementedError()
+    if shuffle:  # works also for CSR matrices, which support row fancy indexing
         # if sk_shuffle:  # TODO this does not work!!! find a way to shuffle these matrices while
         # keeping compatibility with tensorflow!
         #     all_data, all_labels, all_infos = sk_shuffle(all_data, all_labels, all_infos)
         # else:
-        permutation = np.arange(all_data.shape[0])
-        np.random.shuffle(permutation)
+        permutation = np.random.permutation(N)  # one permutation shared by data, labels and infos
 
         all_data = all_data[permutation]
-        all_labels = np.array(all_labels[permutation])
-        all_infos = np.array(all_infos[permutation])
+        all_labels = all_labels[permutation]  # fancy indexing already returns new arrays
+        all_infos = all_infos[permutation]
+        if class_indices is not None:  # follows the examples to their new positions
+            new_positions = np.empty(N, dtype=np.int64)
+            new_positions[permutation] = np.arange(N)
+            class_indices = {c: new_positions[idx] for c, idx in class_indices.items()}
+
+    if filters or maps: class_indices = None
 
     if filters:
-        if sp and isinstance(all_data, sp.sparse.csr.csr_matrix): raise NotImplementedError()
+        if _is_csr(all_data): raise NotImplementedError()
         filters = as_list(filters)
-        data_triple = [(x, y, d) for x, y, d in zip(all_data, all_labels, all_infos)]
-        for fiat in filters:
-            data_triple = [xy for i, xy in enumerate(data_triple) if fiat(xy[0], xy[1], xy[2], i)]
-        all_data = np.vstack([e[0] for e in data_triple])
-        all_labels = np.vstack([e[1] for e in data_triple])
-        all_infos = np.vstack([e[2] for e in data_triple])
+        for fiat in filters:  # builds a boolean mask and slices each array once
+            if _is_batched(fiat):
+                mask = np.asarray(fiat(all_data, all_labels, all_infos, np.arange(all_data.shape[0])), dtype=bool)
+            else:
+                mask = np.fromiter((fiat(x, y, d, i) for i, (x, y, d)
+                                    in enumerate(zip(all_data, all_labels, all_infos))),
+                                   dtype=bool, count=all_data.shape[0])
+            all_data, all_labels, all_infos = all_data[mask], all_labels[mask], all_infos[mask]
 
     if maps:
-        if sp and isinstance(all_data, sp.sparse.csr.csr_matrix): raise NotImplementedError()
+        if _is_csr(all_data): raise NotImplementedError()
         maps = as_list(maps)
-        data_triple = [(x, y, d) for x, y, d in zip(all_data, all_labels, all_infos)]
         for _map in maps:
-            data_triple = [_map(xy[0], xy[1], xy[2], i) for i, xy in enumerate(data_triple)]
-        all_data = np.vstack([e[0] for e in data_triple])
-        all_labels = np.vstack([e[1] for e in data_triple])
-        all_infos = np.vstack([e[2] for e in data_triple])
+            if _is_batched(_map):
+                all_data, all_labels, all_infos = _map(all_data, all_labels, all_infos, np.arange(all_data.shape[0]))
+                continue
+            new_data, new_labels, new_infos = [], [], []
+            for i, (x, y, d) in enumerate(zip(all_data, all_labels, all_infos)):
+                x, y, d = _map(x, y, d, i)
+                new_data.append(x)
+                new_labels.append(y)
+                new_infos.append(d)
+            all_data = np.vstack(new_data)
+            all_labels = np.vstack(new_labels)
+            all_infos = np.empty(len(new_infos), dtype=object)
+            all_infos[:] = new_infos
 
     N = all_data.shape[0]
     assert N == all_labels.shape[0]
 
-    calculated_partitions = reduce(
-        lambda v1, v2: v1 + [sum(v1) + v2],
-        [int(N * prp) for prp in partition_proportions],
-        [0]
-    )
+    sizes = np.array([int(N * prp) for prp in partition_proportions], dtype=np.int64)
+    calculated_partitions = np.concatenate(([0], np.cumsum(sizes)))
     calculated_partitions[-1] = N
 
     print('datasets.redivide_data:, computed partitions numbers -',
@@ -459,16 +674,18 @@ def redivide_data(datasets, partition_proportions=None, shuffle=False, filters=N
 
         if balance_classes:
             new_datasets = []
-            forbidden_indices = np.empty(0, dtype=np.int64)
+            used_indices = [np.empty(0, dtype=np.int64)]
             for d1, d2 in zip(calculated_partitions[:-1], calculated_partitions[1:-1]):
-                indices = np.array(get_indices_balanced_classes(d2 - d1, all_labels, forbidden_indices))
+                indices = np.array(get_indices_balanced_classes(d2 - d1, all_labels, np.concatenate(used_indices),
+                                                                class_indices=class_indices), dtype=np.int64)
                 dataset = Dataset(data=all_data[indices], target=all_labels[indices],
                                   sample_info=all_infos[indices],
                                   info=new_general_info_dict)
                 new_datasets.append(dataset)
-                forbidden_indices = np.append(forbidden_indices, indices)
+                used_indices.append(indices)
                 test_if_balanced(dataset)
-            remaining_indices = np.array(list(set(list(range(N))) - set(forbidden_indices)))
+            remaining_indices = np.setdiff1d(np.arange(N, dtype=np.int64), np.concatenate(used_indices),
+                                             assume_unique=True)
             new_datasets.append(Dataset(data=all_data[remaining_indices], target=all_labels[remaining_indices],
                                         sample_info=all_infos[remaining_indices],
                                         info=new_general_info_dict))
@@ -484,17 +701,26 @@ def redivide_data(datasets, partition_proportions=None, shuffle=False, filters=N
         return new_datasets
 
 
-def get_indices_balanced_classes(n_examples, labels, forbidden_indices):
-    N = len(labels)
+def get_indices_balanced_classes(n_examples, labels, forbidden_indices, class_indices=None):
     n_classes = len(labels[0])
+    if class_indices is None:
+        classes = np.argmax(labels, axis=1)
+        class_indices = {c: np.where(classes == c)[0] for c in range(n_classes)}
+
+    pools = []  # shuffled pool of allowed indices for each class
+    for c in range(n_classes):
+        pool = np.setdiff1d(class_indices.get(c, np.empty(0, dtype=np.int64)), forbidden_indices)
+        np.random.shuffle(pool)
+        pools.append(pool)
+    cursors = [0] * n_classes
 
     indices = []
     current_class = 0
     for i in range(n_examples):
-        index = np.random.random_integers(0, N - 1, 1)[0]
-        while index in indices or index in forbidden_indices or np.argmax(labels[index]) != current_class:
-            index = np.random.random_integers(0, N - 1, 1)[0]
-        indices.append(index)
+        if cursors[current_class] == len(pools[current_class]):
+            raise ValueError('Not enough examples of class %d to build a balanced partition' % current_class)
+        indices.append(pools[current_class][cursors[current_class]])
+        cursors[current_class] += 1
         current_class = (current_class + 1) % n_classes
 
     return indices
@@ -502,39 +728,75 @@ def get_indices_balanced_classes(n_examples, labels, forbidden_indices):
 
 def test_if_balanced(dataset):
     labels = dataset.target
-    n_classes = len(labels[0])
-    class_counter = [0] * n_classes
-    for l in labels:
-        class_counter[np.argmax(l)] += 1
+    class_counter = np.bincount(np.argmax(labels, axis=1), minlength=labels.shape[1]).tolist()
     print('exemple by class: ', class_counter)
 
 
+def _load_csr_with_cache(cache_path, loader, use_cache=True, source_path=None):
+    """
+    Loads a sparse dataset, storing the result in a `.npz` file the first time, so that subsequent calls skip
+    the (slow) parsing or vectorization done by `loader`.
+
+    :param cache_path: path of the `.npz` cache file
+    :param loader: function with no arguments that returns (CSR data matrix, targets, target names or None)
+    :param use_cache: (default True) if False always calls `loader` and does not write the cache
+    :param source_path: (optional) file read by `loader`: the cache is rebuilt if this file is newer
+    :return: the triplet (data, targets, target names or None)
+    """
+    if use_cache and os.path.exists(cache_path) and (
+            source_path is None or os.path.getmtime(source_path) <= os.path.getmtime(cache_path)):
+        with np.load(cache_path) as npz:
+            X = _optional_import('scipy.sparse').csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                                                            shape=tuple(npz['shape']))
+            names = npz['target_names'].tolist() if npz['has_target_names'] else None
+            return X, npz['y'], names
+    X, y, names = loader()
+    if use_cache:
+        X = X.tocsr()
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())  # an interrupted write leaves no truncated cache
+        try:
+            with open(tmp_path, 'wb') as npz_file:
+                np.savez(npz_file, data=X.data, indices=X.indices, indptr=X.indptr, shape=np.array(X.shape), y=y,
+                         target_names=np.array(names if names is not None else []),
+                         has_target_names=names is not None)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print('datasets: could not write %s (%s), the dataset is not cached' % (cache_path, e))
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+    return X, y, names
+
+
 def load_20newsgroup_vectorized(folder=SCIKIT_LEARN_DATA, one_hot=True, partitions_proportions=None,
-                                shuffle=False, binary_problem=False, as_tensor=True, minus_value=-1.):
-    data_train = sk_dt.fetch_20newsgroups_vectorized(data_home=folder, subset='train')
-    data_test = sk_dt.fetch_20newsgroups_vectorized(data_home=folder, subset='test')
-
-    X_train = data_train.data
-    X_test = data_test.data
-    y_train = data_train.target
-    y_test = data_test.target
+                                shuffle=False, binary_problem=False, as_tensor=True, minus_value=-1., use_cache=True):
+    def fetch(subset):
+        def _loader():
+            sk_dt = _optional_import('sklearn.datasets')
+            bunch = sk_dt.fetch_20newsgroups_vectorized(data_home=folder, subset=subset)
+            return bunch.data, bunch.target, list(bunch.target_names)
+
+        return _load_csr_with_cache(os.path.join(folder, '20newsgroup_vectorized_%s.npz' % subset), _loader,
+                                    use_cache=use_cache)
+
+    X_train, y_train, target_names = fetch('train')
+    X_test, y_test, _ = fetch('test')
     if binary_problem:
-        y_train[data_train.target < 10] = minus_value
-        y_train[data_train.target >= 10] = 1.
-        y_test[data_test.target < 10] = minus_value
-        y_test[data_test.target >= 10] = 1.
+        original_y_train, original_y_test = y_train.copy(), y_test.copy()
+        y_train[original_y_train < 10] = minus_value
+        y_train[original_y_train >= 10] = 1.
+        y_test[original_y_test < 10] = minus_value
+        y_test[original_y_test >= 10] = 1.
     if one_hot:
-        y_train = to_one_hot_enc(y_train)
-        y_test = to_one_hot_enc(y_test)
+        y_train = _one_hot(y_train)
+        y_test = _one_hot(y_test)
 
     # if shuffle and sk_shuffle:
     #     xtr = X_train.tocoo()
     #     xts = X_test.tocoo()
 
     d_train = Dataset(data=X_train,
-                      target=y_train, info={'target names': data_train.target_names})
+                      target=y_train, info={'target names': target_names})
     d_test = Dataset(data=X_test,
-                     target=y_test, info={'target names': data_train.target_names})
+                     target=y_test, info={'target names': target_names})
     res = [d_train, d_test]
     if partitions_proportions:
         res = redivide_data([d_train, d_test], partition_proportions=partitions_proportions, shuffle=False)
@@ -544,11 +806,17 @@ def load_20newsgroup_vectorized(folder=SCIKIT_LEARN_DATA, one_hot=True, partitio
     return Datasets.from_list(res)
 
 
-def load_realsim(folder=REALSIM, one_hot=True, partitions_proportions=None, shuffle=False, as_tensor=True):
-    X, y = sk_dt.load_svmlight_file(folder + "/real-sim")
-    y = np.array([int(yy) for yy in y])
+def load_realsim(folder=REALSIM, one_hot=True, partitions_proportions=None, shuffle=False, as_tensor=True,
+                 use_cache=True):
+    def _loader():
+        sk_dt = _optional_import('sklearn.datasets')
+        return sk_dt.load_svmlight_file(folder + "/real-sim") + (None,)
+
+    X, y, _ = _load_csr_with_cache(folder + "/real-sim.npz", _loader, use_cache=use_cache,
+                                   source_path=folder + "/real-sim")
+    y = np.asarray(y, dtype=np.int64)
     if one_hot:
-        y = to_one_hot_enc(y)
+        y = _one_hot(y)
     res = [Dataset(data=X, target=y)]
     if partitions_proportions:
         res = redivide_data(res, shuffle=shuffle, partition_proportions=partitions_proportions)
@@ -580,36 +848,47 @@ def load_XRMB(folder=XRMB_DIR, half_window=2, max_speakers=100, only_independent
         assert set_type in set_types
         files = (prefix + str(speaker_number).zfill(3) + "_%s%s.csv" % (set_type, data_type)
                  for data_type in ('audio', 'motor', 'sentences'))
-        arrays = [pd.read_csv(fl, header=None).values for fl in files]
+        arrays = [read_csv_values(fl, dtype=dt) for fl, dt in zip(files, (np.float32, np.float32, np.int64))]
         return arrays[0], arrays[1], arrays[2] - 1  # sentence bounds are with MATLAB convetions
 
     def load_all_in(_range=range(1)):
         datasets = {n: [] for n in set_types}
         m, mo, sd, sto = None, None, None, None
         k = 0
-        for set_type in set_types:
-            for k in _range:
-                try:
-                    general_info_dict = {'speaker': k, 'original set': set_type}
-                    data, targets, sentence_bounds = load_speaker(k, set_type)
-                    if normalize_single_speaker and k != 0:  # with k = 0 use mean and sd from training set
-                        data, m_sd, sd_sd = np_normalize_data(data, return_mean_and_sd=True)
-                        targets, mo_sd, sto_sd = np_normalize_data(targets, return_mean_and_sd=True)
-                        general_info_dict['normalizing stats'] = (m_sd, sd_sd, mo_sd, sto_sd)
-                    else:
-                        data, m, sd = np_normalize_data(data, m, sd, return_mean_and_sd=True)
-                        targets, mo, sto = np_normalize_data(targets, mo, sto, return_mean_and_sd=True)
-                        general_info_dict['normalizing stats'] = (m, sd, mo, sto)
-
-                    data = WindowedData(data, sentence_bounds, window=half_window, process_all=True)
-                    datasets[set_type].append(Dataset(data, targets,
-                                                      sample_info={'speaker': k} if k != 0 else None,
-                                                      info=general_info_dict))
-
-                except OSError or FileNotFoundError:
-                    k -= 1
-                    break
-            print('loaded %d speakers for %s' % (k, set_type))
+        # csv reading is IO bound and pandas releases the GIL while parsing: the files of the next speakers are
+        # read concurrently (at most n_workers ahead, to bound the memory held by the raw arrays), while
+        # normalization is done sequentially below (it uses the statistics of the first speaker)
+        n_workers = min(16, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for set_type in set_types:
+                pending, loaded = iter(_range), {}
+                for k in _range:
+                    for j in pending:
+                        loaded[j] = executor.submit(load_speaker, j, set_type)
+                        if len(loaded) >= n_workers: break
+                    try:
+                        general_info_dict = {'speaker': k, 'original set': set_type}
+                        data, targets, sentence_bounds = loaded.pop(k).result()
+                        if normalize_single_speaker and k != 0:  # with k = 0 use mean and sd from training set
+                            data, m_sd, sd_sd = np_normalize_data(data, return_mean_and_sd=True)
+                            targets, mo_sd, sto_sd = np_normalize_data(targets, return_mean_and_sd=True)
+                            general_info_dict['normalizing stats'] = (m_sd, sd_sd, mo_sd, sto_sd)
+                        else:
+                            data, m, sd = np_normalize_data(data, m, sd, return_mean_and_sd=True)
+                            targets, mo, sto = np_normalize_data(targets, mo, sto, return_mean_and_sd=True)
+                            general_info_dict['normalizing stats'] = (m, sd, mo, sto)
+
+                        data = WindowedData(data, sentence_bounds, window=half_window, process_all=True)
+                        datasets[set_type].append(Dataset(data, targets,
+                                                          sample_info={'speaker': k} if k != 0 else None,
+                                                          info=general_info_dict))
+
+                    except OSError or FileNotFoundError:
+                        k -= 1
+                        break
+                for future in loaded.values():  # reads past the last speaker
+                    future.cancel()
+                print('loaded %d speakers for %s' % (k, set_type))
 
         return datasets
 
@@ -617,10 +896,10 @@ def load_XRMB(folder=XRMB_DIR, half_window=2, max_speakers=100, only_independent
         res = load_all_in(range(0, max_speakers))
 
         for _set_type in set_types:  # sample-wise speaker info to the general datasets
-            res[_set_type][0].sample_info_dicts = np.concatenate([
-                                                                     np.array([{'speaker': k + 1}] * ds.num_examples)
-                                                                     for k, ds in enumerate(res[_set_type][1:])
-                                                                     ])
+            res[_set_type][0].sample_info_dicts = concatenate_sample_infos([
+                _SampleInfoSoA.from_dict({'speaker': k + 1}, ds.num_examples)
+                for k, ds in enumerate(res[_set_type][1:])
+            ])
 
         return Datasets(train=res['train'], validation=res['val'], test=res['test'])
     else:
@@ -650,8 +929,8 @@ def load_timit_for_joint_training(folder, small=False, one_hot=True, only_gender
         set_names = ['train_small', 'validation_small', 'coretest_small']
     else:
         set_names = ['train', 'validation', 'coretest']
-    Xall = {}
-    Yall = {}
+    Xall = {s: [] for s in set_names}
+    Yall = {s: [] for s in set_names}
     datasets = [None]
     for gender in ['F', 'M']:
         _temp_gender = []
@@ -666,15 +945,12 @@ def load_timit_for_joint_training(folder, small=False, one_hot=True, only_gender
                 X = data[:, :-1]
                 Y = data[:, -1]
                 if one_hot:
-                    Y = to_one_hot_enc(np.array(Y, dtype=np.int32), dimension=183)
+                    Y = _one_hot(Y, 183)
                 info = {'group': dr, 'gender': gender}
                 sets.append(Dataset(X, Y, info=info))
-                # Stacking data for full dataset
-                Xall[s] = np.vstack((Xall[s], X)) if s in Xall else X
-                if one_hot:
-                    Yall[s] = np.vstack((Yall[s], Y)) if s in Yall else Y
-                else:
-                    Yall[s] = np.hstack((Yall[s], Y)) if s in Yall else Y
+                # Stashing data for full dataset (concatenated once at the end)
+                Xall[s].append(X)
+                Yall[s].append(Y)
             ds = Datasets(train=sets[0], validation=sets[1], test=sets[2])
             if not only_gender:
                 datasets.append(ds)
@@ -682,6 +958,8 @@ def load_timit_for_joint_training(folder, small=False, one_hot=True, only_gender
                 _temp_gender.append(ds)
         if only_gender:
             datasets.append(Datasets.stack(*_temp_gender))
+    Xall = {s: np.concatenate(v, axis=0) for s, v in Xall.items()}
+    Yall = {s: np.concatenate(v, axis=0) for s, v in Yall.items()}
     # Building full dataset
     # sets = []
     # for s in set_names:
@@ -698,7 +976,7 @@ def load_timit(folder=TIMIT_DIR, only_primary=False, filters=None, maps=None, sm
                fake=False, process_all=False):
     def load_timit_sentence_bound():
         def sentence_bound_reader(name):
-            bnd = pd.read_csv(folder + '/timit_%sSentenceBound.csv' % name, header=None).values
+            bnd = read_csv_values(folder + '/timit_%sSentenceBound.csv' % name, dtype=np.int64)
             return bnd - 1
 
         return [sentence_bound_reader(n) for n in ['train', 'val', 'test']]
@@ -720,25 +998,27 @@ def load_timit(folder=TIMIT_DIR, only_primary=False, filters=None, maps=None, sm
         training_info_dict = None
     else:
         split_number = '00' if small else ''
-        training_target = pd.read_csv(folder + '/timit_trainTargets%s.csv' % split_number, header=None).values
-        training_data = pd.read_csv(folder + '/timit-preproc_traindata_norm_noctx%s.csv' %
-                                    split_number, header=None).values
+        training_target = read_csv_values(folder + '/timit_trainTargets%s.csv' % split_number)
+        training_data = read_csv_values(folder + '/timit-preproc_traindata_norm_noctx%s.csv' % split_number)
         training_info_dict = {'dim_primary_target': training_target.shape[1]}
         print('loaded primary training data')
         if not only_primary:
-            training_secondary_target = pd.read_csv(folder + '/timit_trainTargetsPE%s.csv'
-                                                    % split_number, header=None).values
-            training_target = np.hstack([training_target, training_secondary_target])
-            training_info_dict['dim_secondary_target'] = training_secondary_target.shape[1]
+            training_secondary_target = read_csv_values(folder + '/timit_trainTargetsPE%s.csv' % split_number)
+            d1, d2 = training_target.shape[1], training_secondary_target.shape[1]
+            full_target = np.empty((training_target.shape[0], d1 + d2), dtype=training_target.dtype)
+            full_target[:, :d1] = training_target
+            full_target[:, d1:] = training_secondary_target
+            training_target = full_target
+            del training_secondary_target, full_target
+            training_info_dict['dim_secondary_target'] = d2
             print('loaded secondary task targets')
 
-        validation_data = pd.read_csv(folder + '/timit-preproc_valdata_norm_noctx%s.csv'
-                                      % split_number, header=None).values
-        validation_target = pd.read_csv(folder + '/timit_valTargets%s.csv' % split_number, header=None).values
+        validation_data = read_csv_values(folder + '/timit-preproc_valdata_norm_noctx%s.csv' % split_number)
+        validation_target = read_csv_values(folder + '/timit_valTargets%s.csv' % split_number)
         print('loaded validation data')
 
-        test_data = pd.read_csv(folder + '/timit-preproc_testdata_norm_noctx.csv', header=None).values
-        test_target = pd.read_csv(folder + '/timit_testTargets.csv', header=None).values
+        test_data = read_csv_values(folder + '/timit-preproc_testdata_norm_noctx.csv')
+        test_target = read_csv_values(folder + '/timit_testTargets.csv')
         print('loaded test data')
 
     if context:
@@ -758,6 +1038,7 @@ def load_timit(folder=TIMIT_DIR, only_primary=False, filters=None, maps=None, sm
 
 def load_mnist(folder=None, one_hot=True, partitions=None, filters=None, maps=None, shuffle=False):
     if not folder: folder = MNIST_DIR
+    from tensorflow.examples.tutorials.mnist.input_data import read_data_sets
     datasets = read_data_sets(folder, one_hot=one_hot)
     train = Dataset(datasets.train.images, datasets.train.labels)
     validation = Dataset(datasets.validation.images, datasets.validation.labels)
@@ -769,8 +1050,71 @@ def load_mnist(folder=None, one_hot=True, partitions=None, filters=None, maps=No
     return Datasets.from_list(res)
 
 
-def load_caltech101_30(folder=CALTECH101_30_DIR, tiny_problem=False):
-    caltech = scio.loadmat(folder + '/caltech101-30.matlab')
+_DATASET_CACHE = {}  # path -> (modification time, loaded content)
+
+
+def _cached_load(path, loader, use_cache=True):
+    """
+    Loads the file at `path` with `loader`, keeping the result in memory so that the decoding is done once per
+    process (it is done again if the file changes). The cached objects are shared between calls: do not
+    modify them in place.
+
+    :param path: path of the file
+    :param loader: function that takes the path and returns its decoded content
+    :param use_cache: (default True) if False always calls `loader` and does not store the result
+    :return: the content of the file
+    """
+    if not use_cache:
+        return loader(path)
+    mtime = os.path.getmtime(path)
+    cached = _DATASET_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _DATASET_CACHE[path] = (mtime, loader(path))
+    return cached[1]
+
+
+def _load_pickle(path):  # the .pickle dataset files are decoded only once, when converted to .npy files
+    with open(path, "rb") as input_file:
+        return pickle.load(input_file)
+
+
+def _load_as_npy(path, names, loader, use_cache=True):
+    """
+    Loads the tuple of arrays stored in the file `path`. The first time (and whenever `path` is modified afterwards)
+    the content is decoded with `loader` and saved as one `.npy` file per array (named `path.<name>.npy`); otherwise
+    these files are memory mapped, skipping the decoding and the extra copy of the arrays. The maps are
+    copy-on-write: the arrays can be modified in place, without changing the files. If the `.npy` files cannot be
+    written (e.g. read-only dataset folder) the decoded arrays are returned.
+
+    :param path: path of the original file
+    :param names: names of the arrays in the tuple returned by `loader`
+    :param loader: function that takes the path and returns the tuple of arrays (or lists)
+    :param use_cache: (default True) if False decodes the original file with `loader`, without reading or
+                        writing the `.npy` files
+    :return: a tuple of arrays (copy-on-write memory maps if the `.npy` files are available)
+    """
+    if not use_cache:
+        return tuple(np.asarray(array) for array in loader(path))
+    npy_paths = ['%s.%s.npy' % (path, name) for name in names]
+    source_mtime = os.path.getmtime(path)
+    if not all(os.path.exists(npy_path) and os.path.getmtime(npy_path) >= source_mtime for npy_path in npy_paths):
+        arrays = loader(path)
+        for npy_path, array in zip(npy_paths, arrays):
+            tmp_path = '%s.%d.tmp' % (npy_path, os.getpid())  # an interrupted write leaves no truncated .npy
+            try:
+                with open(tmp_path, 'wb') as npy_file:
+                    np.save(npy_file, np.ascontiguousarray(array))
+                os.replace(tmp_path, npy_path)
+            except OSError as e:
+                print('datasets: could not write %s (%s), keeping %s in memory' % (npy_path, e, path))
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                return tuple(np.asarray(array) for array in arrays)
+    return tuple(np.load(npy_path, mmap_mode='c') for npy_path in npy_paths)
+
+
+def load_caltech101_30(folder=CALTECH101_30_DIR, tiny_problem=False, use_cache=True):
+    scio = _optional_import('scipy.io')
+    caltech = _cached_load(folder + '/caltech101-30.matlab', scio.loadmat, use_cache=use_cache)
     k_train, k_test = caltech['Ktrain'], caltech['Ktest']
     label_tr, label_te = caltech['tr_label'], caltech['te_label']
     file_tr, file_te = caltech['tr_files'], caltech['te_files']
@@ -778,18 +1122,25 @@ def load_caltech101_30(folder=CALTECH101_30_DIR, tiny_problem=False):
     if tiny_problem:
         pattern_step = 5
         fraction_limit = 0.2
-        k_train = k_train[:int(len(label_tr) * fraction_limit):pattern_step,
-                  :int(len(label_tr) * fraction_limit):pattern_step]
-        label_tr = label_tr[:int(len(label_tr) * fraction_limit):pattern_step]
-
-    U, s, Vh = linalg.svd(k_train)
-    S_sqrt = linalg.diagsvd(s ** 0.5, len(s), len(s))
-    X = np.dot(U, S_sqrt)  # examples in rows
-
-    train_x, val_x, test_x = X[0:len(X):3, :], X[1:len(X):3, :], X[2:len(X):3, :]
-    label_tr_enc = to_one_hot_enc(np.array(label_tr) - 1)
-    train_y, val_y, test_y = label_tr_enc[0:len(X):3, :], label_tr_enc[1:len(X):3, :], label_tr_enc[2:len(X):3, :]
-    train_file, val_file, test_file = file_tr[0:len(X):3], file_tr[1:len(X):3], file_tr[2:len(X):3]
+        limit = int(len(label_tr) * fraction_limit)
+        k_train = k_train[:limit:pattern_step, :limit:pattern_step]
+        label_tr = label_tr[:limit:pattern_step]
+
+    # the kernel matrix is symmetric PSD: its eigendecomposition gives the same embedding as the SVD. Eigenvalues
+    # are sorted in descending order (as the singular values) and the tiny negative ones due to round-off clipped
+    w, U = np.linalg.eigh(k_train)
+    order = np.argsort(-w)
+    X = U[:, order] * np.sqrt(np.clip(w[order], 0, None))  # examples in rows
+
+    # every third example goes to the same set (keeps classes balanced); fancy indexing with the index arrays
+    # gives contiguous copies instead of strided views, so that later reads are sequential
+    n = X.shape[0]
+    train_idx, val_idx, test_idx = (np.arange(k, n, 3) for k in range(3))
+    train_x, val_x, test_x = X[train_idx], X[val_idx], X[test_idx]
+    label_tr_enc = _one_hot(label_tr - 1)
+    train_y, val_y, test_y = label_tr_enc[train_idx], label_tr_enc[val_idx], label_tr_enc[test_idx]
+    file_tr = np.asarray(file_tr)
+    train_file, val_file, test_file = file_tr[train_idx], file_tr[val_idx], file_tr[test_idx]
 
     test_dataset = Dataset(data=test_x, target=test_y, info={'files': test_file})
     validation_dataset = Dataset(data=val_x, target=val_y, info={'files': val_file})
@@ -798,8 +1149,21 @@ def load_caltech101_30(folder=CALTECH101_30_DIR, tiny_problem=False):
     return Datasets(train=training_dataset, validation=validation_dataset, test=test_dataset)
 
 
+def _load_iros15_leg(path):
+    dat = _optional_import('scipy.io').loadmat(path)
+    return dat['X'], dat['Y']
+
+
 def load_iros15(folder=IROS15_BASE_FOLDER, resolution=15, legs='all', part_proportions=(.7, .2), one_hot=True,
-                shuffle=True):
+                shuffle=True, use_cache=True):
+    """
+    Loads the IROS15 datasets, one for each leg.
+
+    The X and Y arrays of each leg are memory mapped (copy-on-write) from `.npy` files created next to the `.mat`
+    file, when the folder is writable. With `shuffle=False` the partitions are slices of the maps, so the data is
+    read from the OS page cache; with `shuffle` (default) the examples are gathered into memory, and the gain is only
+    that the decoded `.mat` contents are not kept around.
+    """
     resolutions = (5, 11, 15)
     legs_names = ('LF', 'LH', 'RF', 'RH')
     assert resolution in resolutions
@@ -810,8 +1174,10 @@ def load_iros15(folder=IROS15_BASE_FOLDER, resolution=15, legs='all', part_propo
 
     datasets = {}
     for _leg in legs:
-        dat = scio.loadmat(base_name_by_leg(_leg))
-        data, target = dat['X'], to_one_hot_enc(dat['Y']) if one_hot else dat['Y']
+        # the .mat file of each leg is decoded only once: then X and Y are memory mapped (not kept in _cached_load:
+        # opening the maps is cheap and each call gets its own copy-on-write arrays)
+        data, target = _load_as_npy(base_name_by_leg(_leg), ('X', 'Y'), _load_iros15_leg, use_cache)
+        if one_hot: target = _one_hot(target)
         # maybe pre-processing??? or it is already done? ask...
         datasets[_leg] = Datasets.from_list(
             redivide_data([Dataset(data, target, info={'leg': _leg})],
@@ -819,24 +1185,41 @@ def load_iros15(folder=IROS15_BASE_FOLDER, resolution=15, legs='all', part_propo
     return datasets
 
 
-def load_caltech101(folder=CALTECH101_DIR, one_hot=True, partitions=None, filters=None, maps=None):
+def _name_ID_dicts(names):
+    """
+    Builds, in a single pass over the class names, the dictionaries name -> ID and ID -> name, where the ID of a
+    class is its position in `names`.
+
+    :param names: sequence (or array) of class names
+    :return: the pair of dictionaries (name -> ID, ID -> name)
+    """
+    name_ID, ID_name = {}, {}
+    for i, name in enumerate(np.asarray(names).tolist()):
+        name_ID[name] = i
+        ID_name[i] = name
+    return name_ID, ID_name
+
+
+def load_caltech101(folder=CALTECH101_DIR, one_hot=True, partitions=None, filters=None, maps=None, use_cache=True,
+                    lazy_sample_info=True):
+    """
+    Loads Caltech101 from `caltech101.pickle`.
+
+    The arrays are memory mapped (copy-on-write) from `.npy` files created next to the pickle file, when the
+    folder is writable: in-place changes to the data (e.g. normalizing) do not modify the files.
+    """
     path = folder + "/caltech101.pickle"
-    with open(path, "rb") as input_file:
-        X, target_name, files = cpickle.load(input_file)
-    dict_name_ID = {}
-    i = 0
-    list_of_targets = sorted(list(set(target_name)))
-    for k in list_of_targets:
-        dict_name_ID[k] = i
-        i += 1
-    dict_ID_name = {v: k for k, v in dict_name_ID.items()}
-    Y = []
-    for name_y in target_name:
-        Y.append(dict_name_ID[name_y])
+    names = ('X', 'target_name', 'files')
+    # not kept in _cached_load: opening the maps is cheap and each call gets its own copy-on-write arrays
+    X, target_name, files = _load_as_npy(path, names, _load_pickle, use_cache)
+    list_of_targets, Y = np.unique(target_name, return_inverse=True)  # sorted names and integer labels
+    dict_name_ID, dict_ID_name = _name_ID_dicts(list_of_targets)
     if one_hot:
-        Y = to_one_hot_enc(Y)
+        Y = _one_hot(Y)
+    sample_info = _SampleInfoSoA({'target_name': np.asarray(target_name), 'files': np.asarray(files)}, len(X)) \
+        if lazy_sample_info else [{'target_name': t, 'files': f} for t, f in zip(target_name, files)]
     dataset = Dataset(data=X, target=Y, info={'dict_name_ID': dict_name_ID, 'dict_ID_name': dict_ID_name},
-                      sample_info=[{'target_name': t, 'files': f} for t, f in zip(target_name, files)])
+                      sample_info=sample_info)
     if partitions:
         res = redivide_data([dataset], partitions, filters=filters, maps=maps, shuffle=True)
         res += [None] * (3 - len(res))
@@ -844,65 +1227,68 @@ def load_caltech101(folder=CALTECH101_DIR, one_hot=True, partitions=None, filter
     return dataset
 
 
-def load_cifar10(folder=CIFAR10_DIR, one_hot=True, partitions=None, filters=None, maps=None, balance_classes=False):
+def load_cifar10(folder=CIFAR10_DIR, one_hot=True, partitions=None, filters=None, maps=None, balance_classes=False,
+                 use_cache=True, lazy_sample_info=True):
+    """
+    Loads CIFAR-10 from `cifar-10.pickle`.
+
+    The arrays are memory mapped (copy-on-write) from `.npy` files created next to the pickle file, when the
+    folder is writable: in-place changes to the data (e.g. normalizing) do not modify the files.
+    """
     path = folder + "/cifar-10.pickle"
-    with open(path, "rb") as input_file:
-        X, target_name, files = cpickle.load(input_file)
-    X = np.array(X)
-    dict_name_ID = {}
-    i = 0
-    list_of_targets = sorted(list(set(target_name)))
-    for k in list_of_targets:
-        dict_name_ID[k] = i
-        i += 1
-    dict_ID_name = {v: k for k, v in dict_name_ID.items()}
-    Y = []
-    for name_y in target_name:
-        Y.append(dict_name_ID[name_y])
+    names = ('X', 'target_name', 'files')
+    # not kept in _cached_load: opening the maps is cheap and each call gets its own copy-on-write arrays
+    X, target_name, files = _load_as_npy(path, names, _load_pickle, use_cache)
+    list_of_targets, Y = np.unique(target_name, return_inverse=True)  # sorted names and integer labels
+    dict_name_ID, dict_ID_name = _name_ID_dicts(list_of_targets)
+    # class strata for the balanced partitions, computed once from the integer labels
+    class_indices = {c: np.flatnonzero(Y == c) for c in range(len(list_of_targets))} if partitions else None
     if one_hot:
-        Y = to_one_hot_enc(Y)
+        Y = _one_hot(Y)
+    sample_info = _SampleInfoSoA({'target_name': np.asarray(target_name), 'files': np.asarray(files)}, len(X)) \
+        if lazy_sample_info else [{'target_name': t, 'files': f} for t, f in zip(target_name, files)]
     dataset = Dataset(data=X, target=Y, info={'dict_name_ID': dict_name_ID, 'dict_ID_name': dict_ID_name},
-                      sample_info=[{'target_name': t, 'files': f} for t, f in zip(target_name, files)])
+                      sample_info=sample_info)
     if partitions:
-        res = redivide_data([dataset], partitions, filters=filters, maps=maps, shuffle=True, balance_classes=True)
+        res = redivide_data([dataset], partitions, filters=filters, maps=maps, shuffle=True, balance_classes=True,
+                            class_indices=class_indices)
         res += [None] * (3 - len(res))
         return Datasets(train=res[0], validation=res[1], test=res[2])
     return dataset
 
 
-def load_cifar100(folder=CIFAR100_DIR, one_hot=True, partitions=None, filters=None, maps=None):
-    path = folder + "/cifar-100.pickle"
-    with open(path, "rb") as input_file:
-        X, target_ID_fine, target_ID_coarse, fine_ID_corr, coarse_ID_corr, files = cpickle.load(input_file)
-    X = np.array(X);
+def load_cifar100(folder=CIFAR100_DIR, one_hot=True, partitions=None, filters=None, maps=None, use_cache=True,
+                  lazy_sample_info=True):
+    """
+    Loads CIFAR-100 from `cifar-100.pickle`.
 
-    target_ID_fine = target_ID_fine[:len(X)]
-    target_ID_coarse = target_ID_coarse[:len(X)]
+    The arrays are memory mapped (copy-on-write) from `.npy` files created next to the pickle file, when the
+    folder is writable: in-place changes to the data (e.g. normalizing) do not modify the files.
+    """
+    path = folder + "/cifar-100.pickle"
+    names = ('X', 'target_ID_fine', 'target_ID_coarse', 'fine_ID_corr', 'coarse_ID_corr', 'files')
+    # not kept in _cached_load: opening the maps is cheap and each call gets its own copy-on-write arrays
+    X, target_ID_fine, target_ID_coarse, fine_ID_corr, coarse_ID_corr, files = _load_as_npy(path, names, _load_pickle,
+                                                                                            use_cache)
 
-    fine_ID_corr = {v: k for v, k in zip(range(len(fine_ID_corr)), fine_ID_corr)}
-    coarse_ID_corr = {v: k for v, k in zip(range(len(coarse_ID_corr)), coarse_ID_corr)}
-    fine_label_corr = {v: k for k, v in fine_ID_corr.items()}
-    coarse_label_corr = {v: k for k, v in coarse_ID_corr.items()}
+    fine_label_corr, fine_ID_corr = _name_ID_dicts(fine_ID_corr)
+    coarse_label_corr, coarse_ID_corr = _name_ID_dicts(coarse_ID_corr)
 
-    Y = []
-    for name_y in target_ID_fine:
-        Y.append(name_y)
-    Y = np.array(Y)
+    Y = np.asarray(target_ID_fine[:len(X)], dtype=np.int64)
     if one_hot:
-        Y = to_one_hot_enc(Y)
-    superY = []
-    for name_y in target_ID_coarse:
-        superY.append(name_y)
-    superY = np.array(superY)
+        Y = _one_hot(Y)
+    superY = np.asarray(target_ID_coarse[:len(X)], dtype=np.int64)
     if one_hot:
-        superY = to_one_hot_enc(superY)
+        superY = _one_hot(superY)
 
     print(len(X))
     print(len(Y))
+    sample_info = _SampleInfoSoA({'Y_coarse': superY, 'files': np.asarray(files)[:len(X)]}, len(X)) \
+        if lazy_sample_info else [{'Y_coarse': yc, 'files': f} for yc, f in zip(superY, files)]
     dataset = Dataset(data=X, target=Y,
                       info={'dict_name_ID_fine': fine_label_corr, 'dict_name_ID_coarse': coarse_label_corr,
                                          'dict_ID_name_fine': fine_ID_corr, 'dict_ID_name_coarse': coarse_ID_corr},
-                      sample_info=[{'Y_coarse': yc, 'files': f} for yc, f in zip(superY, files)])
+                      sample_info=sample_info)
     if partitions:
         res = redivide_data([dataset], partitions, filters=filters, maps=maps, shuffle=True)
         res += [None] * (3 - len(res))
@@ -917,6 +1303,7 @@ def generate_multiclass_dataset(n_samples=100, n_features=10,
                                 hypercube=True, shift=0.0, scale=1.0,
                                 shuffle=True, random_state=None, hot_encoded=True, partitions_proportions=None,
                                 negative_labels=-1.):
+    sk_dt = _optional_import('sklearn.datasets')
     X, y = sk_dt.make_classification(n_samples=n_samples, n_features=n_features,
                                      n_informative=n_informative, n_redundant=n_redundant, n_repeated=n_repeated,
                                      n_classes=n_classes, n_clusters_per_class=n_clusters_per_class,
@@ -924,10 +1311,10 @@ def generate_multiclass_dataset(n_samples=100, n_features=10,
                                      hypercube=hypercube, shift=shift, scale=scale,
                                      shuffle=True, random_state=random_state)
     if hot_encoded:
-        y = to_one_hot_enc(y)
+        y = _one_hot(y, dtype=np.float32)
     else:
         y[y == 0] = negative_labels
-    res = Dataset(data=np.array(X, dtype=np.float32), target=np.array(y, dtype=np.float32),
+    res = Dataset(data=X.astype(np.float32, copy=False), target=np.asarray(y, dtype=np.float32),
                   info={'n_informative': n_informative, 'n_redundant': n_redundant,
                                      'n_repeated': n_repeated,
                                      'n_classes': n_classes, 'n_clusters_per_class': n_clusters_per_class,
@@ -982,9 +1369,10 @@ class ExampleVisiting:
 
         self.training_schedule = None
         self.iter_per_epoch = int(dataset.num_examples / batch_size)
+        self._bx, self._by = None, None  # mini-batch buffers, reused at every step
 
     def setting(self):
-        excluded = ['training_schedule', 'datasets']
+        excluded = ['training_schedule', 'datasets', '_bx', '_by']
         dictionary = {k: v for k, v in vars(self).items() if k not in excluded}
         if hasattr(self.dataset, 'setting'):
             dictionary['dataset'] = self.dataset.setting()
@@ -996,15 +1384,16 @@ class ExampleVisiting:
 
         :return: self
         """
-
-        def all_indices_shuffled():
-            _res = list(range(self.dataset.num_examples))
-            np.random.shuffle(_res)
-            return _res
-
-        # noinspection PyUnusedLocal
-        self.training_schedule = np.concatenate([all_indices_shuffled()
-                                                 for _ in range(self.epochs or 1)])
+        n = self.dataset.num_examples
+        epochs = self.epochs or 1
+        if self.training_schedule is None or len(self.training_schedule) != epochs * n:
+            self.training_schedule = np.empty(epochs * n, dtype=np.int32 if n <= np.iinfo(np.int32).max else np.int64)
+        for e in range(epochs):  # one permutation per epoch, written in place
+            self.training_schedule[e * n:(e + 1) * n] = np.random.permutation(n)
+        if self._bx is None and isinstance(self.dataset.data, np.ndarray) and \
+                isinstance(self.dataset.target, np.ndarray):
+            self._bx = np.empty((self.batch_size,) + self.dataset.data.shape[1:], dtype=self.dataset.data.dtype)
+            self._by = np.empty((self.batch_size,) + self.dataset.target.shape[1:], dtype=self.dataset.target.dtype)
         return self
 
     def create_supplier(self, x, y, other_feeds=None, lambda_feeds=None):
@@ -1020,7 +1409,8 @@ class ExampleVisiting:
         :param other_feeds: dictionary of other feeds (e.g. dropout factor, ...) to add to the input output
                             feed_dict
         :return: a function that generates a feed_dict with the right signature for Reverse and Forward HyperGradient
-                    classes
+                    classes. The mini-batch arrays are overwritten at the next call: use (or copy) each feed_dict
+                    before asking for the next one.
         """
 
         if not lambda_feeds:
@@ -1043,12 +1433,17 @@ class ExampleVisiting:
                 # print('visiting scheme not yet generated!')
                 self.generate_visiting_scheme()
 
-            # noinspection PyTypeChecker
-            nb = self.training_schedule[step * self.batch_size: min(
-                (step + 1) * self.batch_size, len(self.training_schedule))]
-
-            bx = self.dataset.data[nb, :]
-            by = self.dataset.target[nb, :]
+            bs = self.batch_size
+            nb = self.training_schedule[step * bs: (step + 1) * bs]  # slicing already stops at the end
+
+            if self._bx is not None and nb.shape[0] == bs:  # gather into the preallocated buffers
+                # schedule indices are always valid: mode='clip' lets numpy write directly into `out`
+                # (with the default mode='raise' it gathers into a temporary and copies it back)
+                bx = np.take(self.dataset.data, nb, axis=0, out=self._bx, mode='clip')
+                by = np.take(self.dataset.target, nb, axis=0, out=self._by, mode='clip')
+            else:  # e.g. last (shorter) mini-batch or non-numpy data
+                bx = self.dataset.data[nb, :]
+                by = self.dataset.target[nb, :]
             if lambda_feeds:
                 lambda_processed_feeds = {k: v(nb) for k, v in lambda_feeds.items()}
             else:
@@ -1058,7 +1453,8 @@ class ExampleVisiting:
         return _training_supplier
 
 
-def pad(_example, _size): return np.concatenate([_example] * _size)
+def pad(_example, _size):  # repeats along the first axis (as concatenating _size copies), in a single copy
+    return np.tile(_example, (_size,) + (1,) * (np.ndim(_example) - 1))
 
 
 class WindowedData(object):
@@ -1072,59 +1468,118 @@ class WindowedData(object):
         :param process_all: (default False) if True adds context to all data at object initialization.
                             Otherwise the windowed data is created in runtime.
         """
+        self.version = 0  # increment after modifying `data` in place, so that cached windows are regenerated
         self.window = window
         self.data = data
         base_shape = self.data.shape
         self.shape = (base_shape[0], (2 * self.window + 1) * base_shape[1])
-        self.tree = it.IntervalTree([it.Interval(int(e[0]), int(e[1]) + 1) for e in row_sentence_bounds])
+        # sentences as sorted half-open intervals [start, end): the sentence of a row is found with a binary search
+        bounds = np.asarray(row_sentence_bounds, dtype=np.int64).reshape(-1, 2)
+        bounds = bounds[np.argsort(bounds[:, 0], kind='mergesort')]
+        self._starts = bounds[:, 0]
+        self._ends = bounds[:, 1] + 1
+        self._tree = None
         if process_all:
             print('adding context to all the dataset', end='- ')
             self.data = self.generate_all()
             print('DONE')
         self.process_all = process_all
 
-    def generate_all(self):
-        return self[:]
+    @property
+    def tree(self):
+        """
+        Interval tree of the sentence bounds (built on first access, requires intervaltree; not used for
+        generating the windows)
+        """
+        if self._tree is None:
+            it = _optional_import('intervaltree')
+            self._tree = it.IntervalTree([it.Interval(int(s), int(e)) for s, e in zip(self._starts, self._ends)])
+        return self._tree
+
+    def generate_all(self, out=None):
+        """
+        Generates the windowed data for all the rows.
+
+        :param out: (optional) array of shape `self.shape` in which to write the windowed data, avoiding
+                        a new allocation. Ignored if the data has already been processed.
+        :return: the windowed data
+        """
+        if out is None or getattr(self, 'process_all', False):
+            return self[:]
+        block = 10000  # bounds the size of the temporary index matrix
+        for start in range(0, self.shape[0], block):
+            rows = np.arange(start, min(start + block, self.shape[0]))
+            self._windows(rows, out=out[start:start + block])
+        return out
 
     def __getitem__(self, item):  # TODO should be right for all the common use... But better write down a TestCase
         if hasattr(self, 'process_all') and self.process_all:  # keep attr check!
             return self.data[item]
-        if isinstance(item, int):
+        if isinstance(item, (int, np.integer)):
             return self.get_context(item=item)
         if isinstance(item, tuple):
             if len(item) == 2:
                 rows, columns = item
-                if isinstance(rows, int) and isinstance(columns, int):  # TODO check here
-                    # do you want the particular element?
+                if isinstance(rows, (int, np.integer)):
+                    # do you want the particular element (or some of its columns)?
                     return self.get_context(item=rows)[columns]
             else:
                 raise TypeError('NOT IMPLEMENTED <|>')
             if isinstance(rows, slice):
-                rows = range(*rows.indices(self.shape[0]))
-            return np.vstack([self.get_context(r) for r in rows])[:, columns]
+                rows = np.arange(*rows.indices(self.shape[0]))
+            return self._windows(rows)[:, columns]
         else:
             if isinstance(item, slice):
-                item = range(*item.indices(self.shape[0]))
-            return np.vstack([self.get_context(r) for r in item])
+                item = np.arange(*item.indices(self.shape[0]))
+            return self._windows(item)
 
     def __len__(self):
         return self.shape[0]
 
-    def get_context(self, item):
-        interval = list(self.tree[item])[0]
-        # print(interval)
-        left, right = interval[0], interval[1]
-        left_pad = max(self.window + left - item, 0)
-        right_pad = max(0, self.window - min(right, len(self) - 1) + item)  # this is to cope with reduce datasets
-        # print(left, right, item)
-
-        # print(left_pad, right_pad)
-        base = np.concatenate(self.data[item - self.window + left_pad: item + self.window + 1 - right_pad])
-        if left_pad:
-            base = np.concatenate([pad(self.data[item], left_pad), base])
-        if right_pad:
-            base = np.concatenate([base, pad(self.data[item], right_pad)])
-        return base
+    def _context_indices(self, rows):
+        """
+        Indices of the rows that compose the windows centered in `rows`. Positions falling outside the sentence
+        of the central row are padded with the central row itself.
+
+        :param rows: 1-D array of row indices
+        :return: integer array of shape (len(rows), 2 * window + 1)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        k = np.minimum(np.searchsorted(self._ends, rows, side='right'), len(self._ends) - 1)
+        covered = (self._starts[k] <= rows) & (rows < self._ends[k])  # rows outside any sentence get no context
+        left = np.where(covered, self._starts[k], rows)
+        right = np.where(covered, np.minimum(self._ends[k], len(self) - 1), rows)  # to cope with reduce datasets
+        indices = rows[:, None] + np.arange(-self.window, self.window + 1)
+        inside = (indices >= left[:, None]) & (indices <= right[:, None])
+        return np.where(inside, indices, rows[:, None])
+
+    def _windows(self, rows, out=None):
+        """
+        Windowed data for `rows`, built with a single gather.
+
+        :param rows: 1-D array of row indices
+        :param out: (optional) array of shape (len(rows), self.shape[1]) in which the windows are written directly
+        :return: array of shape (len(rows), self.shape[1])
+        """
+        indices = self._context_indices(rows)
+        if out is None:
+            return self.data[indices].reshape(len(rows), -1)
+        if out.flags.c_contiguous and out.dtype == self.data.dtype:  # gather straight into the output buffer
+            # context indices are always in range: with mode='clip' numpy does not go through a temporary
+            np.take(self.data, indices, axis=0, out=out.reshape(indices.shape + self.data.shape[1:]), mode='clip')
+        else:
+            out[...] = self.data[indices].reshape(len(rows), -1)
+        return out
+
+    def get_context(self, item, out=None):
+        """
+        Windowed data for a single row.
+
+        :param item: index of the row
+        :param out: (optional) 1-D array of length `self.shape[1]` in which the window is written
+        :return: the window, as a 1-D array
+        """
+        return self._windows([item], out=None if out is None else out[None, :])[0]
 #
 #
 # if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import unittest
+from functools import reduce
 from rfho.datasets import *
 
 
@@ -26,6 +27,86 @@ class RepartitionDatasetTest(unittest.TestCase):
         self.assertEqual(len(res[2].data), 10000)
 
 
+class SampleInfoTest(unittest.TestCase):
+
+    def test_dict_sample_info(self):
+        d1 = Dataset(np.random.randn(10, 3), to_one_hot_enc(np.arange(10) % 2), sample_info={'speaker': 1})
+        d2 = Dataset(np.random.randn(5, 3), to_one_hot_enc(np.arange(5) % 2), sample_info={'speaker': 2})
+        self.assertEqual(d1.sample_info[3], {'speaker': 1})
+        self.assertEqual(len(d1.sample_info[2:7]), 5)
+
+        d3 = Dataset(np.random.randn(3, 3), to_one_hot_enc(np.arange(3) % 2), sample_info={'tags': ['a']})
+        d3.sample_info[0]['tags'].append('b')  # values are not shared between examples
+        self.assertEqual(d3.sample_info[1], {'tags': ['a']})
+
+        stacked = Dataset.stack(d1, d2)
+        self.assertEqual(len(stacked.sample_info), 15)
+        self.assertEqual(stacked.sample_info[12], {'speaker': 2})
+
+        res = redivide_data([d1, d2], [.6], shuffle=True)
+        self.assertEqual(sum(len(r.sample_info) for r in res), 15)
+
+
+class BatchedFiltersAndMapsTest(unittest.TestCase):
+
+    def test_batched_and_per_sample_agree(self):
+        dataset = Dataset(np.random.randn(20, 3), to_one_hot_enc(np.arange(20) % 2))
+
+        # noinspection PyUnusedLocal
+        def even(x, y, info, i):
+            return i % 2 == 0
+
+        # noinspection PyUnusedLocal
+        def double(x, y, info, i):
+            return 2 * x, y, info
+
+        res1 = redivide_data([dataset], filters=even, maps=double)
+        res2 = redivide_data([dataset], filters=batched(even), maps=batched(double))
+        self.assertTrue(np.allclose(res1[0].data, res2[0].data))
+        self.assertTrue(np.allclose(res1[0].data, 2 * dataset.data[::2]))
+        self.assertFalse(getattr(even, 'batched', False))  # batched wraps, the per-sample filter is unchanged
+
+
+class WindowedDataTest(unittest.TestCase):
+
+    def test_context_padding(self):
+        data = np.arange(20, dtype=np.float32).reshape(10, 2)
+        windowed = WindowedData(data, np.array([[0, 4], [5, 9]]), window=1)
+        self.assertEqual(windowed.shape, (10, 6))
+        self.assertTrue(np.array_equal(windowed[2], data[1:4].ravel()))
+        # first row of a sentence: left context is padded with the row itself
+        self.assertTrue(np.array_equal(windowed[5], np.concatenate([data[5], data[5], data[6]])))
+        # last row of the dataset: right context is padded with the row itself
+        self.assertTrue(np.array_equal(windowed[9], np.concatenate([data[8], data[9], data[9]])))
+        self.assertTrue(np.array_equal(windowed[:], np.vstack([windowed[r] for r in range(10)])))
+
+
+class LoaderCacheTest(unittest.TestCase):
+
+    def test_modified_pickle_is_reloaded(self):
+        import pickle
+        import tempfile
+        import time
+        path = tempfile.mkdtemp() + '/cifar-10.pickle'
+
+        def write_pickle(value):
+            with open(path, 'wb') as f:
+                pickle.dump((np.full((4, 3), value, dtype=np.float32), ['a', 'b', 'a', 'b'],
+                             ['f%d' % i for i in range(4)]), f)
+
+        write_pickle(1.)
+        self.assertEqual(load_cifar10(os.path.dirname(path)).data[0, 0], 1.)
+        write_pickle(2.)
+        os.utime(path, (time.time() + 10, time.time() + 10))  # surely newer than the .npy files
+        self.assertEqual(load_cifar10(os.path.dirname(path), use_cache=False).data[0, 0], 2.)
+        self.assertEqual(load_cifar10(os.path.dirname(path)).data[0, 0], 2.)
+
+        dataset = load_cifar10(os.path.dirname(path))
+        dataset.data[...] -= 2.  # copy-on-write: in-place changes do not reach the cached files
+        self.assertEqual(dataset.data[0, 0], 0.)
+        self.assertEqual(load_cifar10(os.path.dirname(path)).data[0, 0], 2.)
+
+
 class ExampleVisitingTest(unittest.TestCase):
 
     def test_example_visiting_on_mnist(self):